@@ -1,10 +1,14 @@
 """This is the init module for fitler"""
-from .datafiles import ActivityFileCollection, ActivityFile
-from .metadata import ActivityMetadata
-from .spreadsheet import ActivitySpreadsheet
-from .apis import StravaActivities
-from .apis import RideWithGPSActivities
-from .stravajson import StravaJsonActivities
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .datafiles import ActivityFileCollection, ActivityFile
+    from .metadata import ActivityMetadata
+    from .spreadsheet import ActivitySpreadsheet
+    from .apis import StravaActivities
+    from .apis import RideWithGPSActivities
+    from .stravajson import StravaJsonActivities
 
 __version__ = "0.0.1"
 __all__ = [
@@ -16,3 +20,23 @@ __all__ = [
     "RideWithGPSActivities",
     "StravaJsonActivities",
 ]
+
+# Each source drags in its own heavy dependencies (stravaio, ridewithgps,
+# openpyxl, gpxpy...), so only import a module the first time it is used.
+_LAZY = {
+    "ActivityFileCollection": ".datafiles",
+    "ActivityFile": ".datafiles",
+    "ActivityMetadata": ".metadata",
+    "ActivitySpreadsheet": ".spreadsheet",
+    "StravaActivities": ".apis",
+    "RideWithGPSActivities": ".apis",
+    "StravaJsonActivities": ".stravajson",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    obj = getattr(importlib.import_module(_LAZY[name], __name__), name)
+    globals()[name] = obj
+    return obj
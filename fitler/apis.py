@@ -1,81 +1,179 @@
 """Contains api wrappers for all upstream APIs that we are using"""
-from fitler.metadata import ActivityMetadata
+from fitler.metadata import ActivityMetadata, METERS_TO_MILES, parse_date
 
-import dateparser
-import stravaio  # type: ignore
 import os
+import threading
 import time
-import ridewithgps  # type: ignore
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 
+class RateLimiter(object):
+    # At most `calls` calls in any `period` seconds, shared by every thread.
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self.recent = deque()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            if len(self.recent) == self.calls:
+                oldest = self.recent.popleft()
+                time.sleep(max(0, oldest + self.period - time.monotonic()))
+            self.recent.append(time.monotonic())
+
+
 class StravaActivities(object):
+    # Strava allows 100 requests every 15 minutes
+    rate_limit = (100, 15 * 60)
+    retries = 3
+
     def __init__(self, token):
+        # stravaio pulls in pandas and friends, only pay for it when used
+        import stravaio  # type: ignore
+
         self.activities_metadata = []
         self.client = stravaio.StravaIO(access_token=token)
+        self.rate_limiter = RateLimiter(*self.rate_limit)
 
-    def process(self):
+    def get_activity_by_id(self, activity_id):
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                return self.client.get_activity_by_id(activity_id)
+            except Exception as e:
+                # the list calls and other apps share the quota, so 429s can
+                # still happen. Wait for the window to reset, then try again.
+                if getattr(e, "status", None) != 429 or attempt == self.retries:
+                    raise
+                retry_after = (getattr(e, "headers", None) or {}).get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    time.sleep(int(retry_after))
+                else:
+                    # Strava's windows start on the quarter hour
+                    time.sleep(15 * 60 - time.time() % (15 * 60))
+
+    def process(self, workers=4):
         # TODO: how to load in the stuff stored locally?
 
         list_activitites = (
             self.client.get_logged_in_athlete_activities()
         )  # after='last week')
+
+        known = {
+            am.strava_id: am
+            for am in ActivityMetadata.select().where(
+                ActivityMetadata.source == "Strava"
+            )
+        }
+        new_activities = []
+        changed = {}
+
+        # Only activities we haven't stored yet need their details fetched.
+        # The summary already has everything we keep for the stored ones.
+        unknown = []
         for a in list_activitites:
-            try:
-                activity = self.client.get_activity_by_id(a.id)
-                activity.store_locally()
-                activity_dict = activity.to_dict()
+            if a.id in known:
+                am = known[a.id]
+                if am.update_fields(
+                    {
+                        "date": parse_date(a.start_date_local),
+                        "distance": a.distance * METERS_TO_MILES,
+                        "notes": a.name,
+                    }
+                ):
+                    changed[am.id] = am
+                self.activities_metadata.append(am)
+            else:
+                unknown.append(a)
 
-                am_dict = {}
+        # Fetching each activity is a slow round trip, keep a few in flight at
+        # once. Results are still handled one at a time, in order, below.
+        rate_limited = False
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetches = [executor.submit(self.get_activity_by_id, a.id) for a in unknown]
+            for fetch in fetches:
+                if fetch.cancelled():
+                    continue
+                try:
+                    am = self.process_activity(fetch.result())
+                except Exception as e:
+                    if getattr(e, "status", None) == 429:
+                        # still rate limited after retrying: stop asking, keep
+                        # what we have and let the next run fetch the rest
+                        if not rate_limited:
+                            print("Strava rate limit reached, stopping early:", e)
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            rate_limited = True
+                        continue
+                    # TODO: fix ValueError: Invalid value for
+                    #  `activity_type` (Hike), must be one of ['Ride', 'Run']
+                    print("Exception Saving Strava Activity:", e)
+                    continue
 
-                am_dict["date"] = dateparser.parse(
-                    activity_dict["start_date_local"]
-                ).strftime("%Y-%m-%d")
-                # am_dict['activity_type'] = activity_type
-                # am_dict['location_name'] = location_name
-                # am_dict['city'] = city  ---> get from start_latlng
-                # am_dict['state'] = state  ---> get from start_latlng
-                # am_dict['temperature'] = temperature
-                # am_dict['equipment'] = equipment
-                #     ---> get from gear_id and join
-                # am_dict['duration_hms'] = duration_hms
-                #     ---> get from elapsed_time in s
-                am_dict["distance"] = (
-                    activity_dict["distance"] * 0.00062137
-                )  # source data is in meters, convert to miles
-                # am_dict['max_speed'] = max_speed
-                #     --->  convert from m/s to mph
-                # am_dict['avg_heart_rate'] = avg_heart_rate
-                #  am_dict['calories'] = calories
-                # am_dict['max_elevation'] = max_elevation
-                # am_dict['total_elevation_gain'] = total_elevation_gain
-                # am_dict['with_names'] = with_names
-                # am_dict['avg_heart_rate'] = avg_heart_rate
-                am_dict["strava_id"] = activity_dict["id"]
-                # if garmin_id := row[18]: am_dict['garmin_id'] = garmin_id
-                am_dict["notes"] = activity_dict["name"]
-                am_dict["source"] = "Strava"
-
-                am, created = ActivityMetadata.get_or_create(**am_dict)
-                am.save()
+                if am.strava_id in known:
+                    am = known[am.strava_id]
+                else:
+                    known[am.strava_id] = am
+                    new_activities.append(am)
                 self.activities_metadata.append(am)
-                time.sleep(2)
-            except Exception as e:
-                # TODO: fix ValueError: Invalid value for
-                #  `activity_type` (Hike), must be one of ['Ride', 'Run']
-                print("Exception Saving Strava Activity:", e)
+
+        ActivityMetadata.bulk_save(
+            new_activities,
+            ActivityMetadata.strava_id,
+            list(changed.values()),
+            [ActivityMetadata.date, ActivityMetadata.distance, ActivityMetadata.notes],
+        )
 
         # TODO: destroy the client somehow
 
+    def process_activity(self, activity):
+        activity.store_locally()
+        activity_dict = activity.to_dict()
+
+        am_dict = {}
+
+        am_dict["date"] = parse_date(activity_dict["start_date_local"])
+        # am_dict['activity_type'] = activity_type
+        # am_dict['location_name'] = location_name
+        # am_dict['city'] = city  ---> get from start_latlng
+        # am_dict['state'] = state  ---> get from start_latlng
+        # am_dict['temperature'] = temperature
+        # am_dict['equipment'] = equipment
+        #     ---> get from gear_id and join
+        # am_dict['duration_hms'] = duration_hms
+        #     ---> get from elapsed_time in s
+        am_dict["distance"] = (
+            activity_dict["distance"] * METERS_TO_MILES
+        )  # source data is in meters, convert to miles
+        # am_dict['max_speed'] = max_speed
+        #     --->  convert from m/s to mph
+        # am_dict['avg_heart_rate'] = avg_heart_rate
+        #  am_dict['calories'] = calories
+        # am_dict['max_elevation'] = max_elevation
+        # am_dict['total_elevation_gain'] = total_elevation_gain
+        # am_dict['with_names'] = with_names
+        # am_dict['avg_heart_rate'] = avg_heart_rate
+        am_dict["strava_id"] = activity_dict["id"]
+        # if garmin_id := row[18]: am_dict['garmin_id'] = garmin_id
+        am_dict["notes"] = activity_dict["name"]
+        am_dict["source"] = "Strava"
+
+        return ActivityMetadata(**am_dict)
+
 
 class RideWithGPSActivities(object):
-    def __init__(self):
+    def __init__(self, email=None, password=None, apikey=None):
+        import ridewithgps  # type: ignore
+
         self.activities_metadata = []
         self.client = ridewithgps.RideWithGPS()
 
-        self.username = os.environ["RIDEWITHGPS_EMAIL"]
-        self.password = os.environ["RIDEWITHGPS_PASSWORD"]
-        self.apikey = os.environ["RIDEWITHGPS_KEY"]
+        self.username = email or os.environ["RIDEWITHGPS_EMAIL"]
+        self.password = password or os.environ["RIDEWITHGPS_PASSWORD"]
+        self.apikey = apikey or os.environ["RIDEWITHGPS_KEY"]
 
         auth = self.client.call(
             "/users/current.json",
@@ -90,77 +188,79 @@ class RideWithGPSActivities(object):
         self.userid = auth["user"]["id"]
         self.auth_token = auth["user"]["auth_token"]
 
+        # every write below goes to the same host, keep the connection open
+        self.session = requests.Session()
+        self.auth_payload = {
+            "apikey": self.apikey,
+            "version": 2,
+            "auth_token": self.auth_token,
+        }
+        self.gear_url = "/users/{0}/gear.json".format(self.userid)
+        self.trips_url = "/users/{0}/trips.json".format(self.userid)
+
     def set_trip_gear(self, trip_id, gear_id):
-        requests.put(
-            "https://ridewithgps.com/trips/{0}.json".format(trip_id),
-            json={
-                "apikey": self.apikey,
-                "version": 2,
-                "auth_token": self.auth_token,
-                "trip": {"gear_id": gear_id},
-            },
-        )
+        self.update_trip(trip_id, {"gear_id": gear_id})
 
     def set_trip_name(self, trip_id, name):
-        requests.put(
+        self.update_trip(trip_id, {"name": name})
+
+    def update_trip(self, trip_id, trip):
+        self.session.put(
             "https://ridewithgps.com/trips/{0}.json".format(trip_id),
-            json={
-                "apikey": self.apikey,
-                "version": 2,
-                "auth_token": self.auth_token,
-                "trip": {"name": name},
-            },
+            json={**self.auth_payload, "trip": trip},
         )
 
+    def update_trips(self, trips):
+        # trips maps trip id -> every field to change on it. There is no bulk
+        # endpoint, but this is at least one request per trip, not per field.
+        for trip_id, trip in trips.items():
+            self.update_trip(trip_id, trip)
+
     def create_trip(self, file_path):
-        requests.post(
-            "https://ridewithgps.com/trips.json",
-            files={"file": open(file_path, "rb")},
-            data={
-                "apikey": self.apikey,
-                "version": 2,
-                "auth_token": self.auth_token,
-            },
-        )
+        with open(file_path, "rb") as trip_file:
+            self.session.post(
+                "https://ridewithgps.com/trips.json",
+                files={"file": trip_file},
+                data=self.auth_payload,
+            )
 
     def get_gear(self):
         gear = {}
         gear_results = self.client.call(
-            "/users/{0}/gear.json".format(self.userid),
-            {
-                "offset": 0,
-                "limit": 100,
-                "apikey": self.apikey,
-                "version": 2,
-                "auth_token": self.auth_token,
-            },
+            self.gear_url, {**self.auth_payload, "offset": 0, "limit": 100}
         )["results"]
         for g in gear_results:
             gear[g["id"]] = g["nickname"]
         return gear
 
     def process(self):
-        gear = self.get_gear()
+        # gear and trips are independent requests, wait on both at once
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            gear_fetch = executor.submit(self.get_gear)
+            trips_fetch = executor.submit(
+                self.client.call,
+                self.trips_url,
+                {**self.auth_payload, "offset": 0, "limit": 10000},
+            )
+            gear = gear_fetch.result()
+            activities = trips_fetch.result()["results"]
+
+        known = {
+            am.ridewithgps_id: am
+            for am in ActivityMetadata.select().where(
+                ActivityMetadata.source == "RideWithGPS"
+            )
+        }
+        new_activities = []
+        changed = {}
 
-        activities = self.client.call(
-            "/users/{0}/trips.json".format(self.userid),
-            {
-                "offset": 0,
-                "limit": 10000,
-                "apikey": self.apikey,
-                "version": 2,
-                "auth_token": self.auth_token,
-            },
-        )["results"]
         for a in activities:
             try:
                 am_dict = {}
 
-                am_dict["date"] = dateparser.parse(a["departed_at"]).strftime(
-                    "%Y-%m-%d"
-                )
+                am_dict["date"] = parse_date(a["departed_at"])
                 am_dict["distance"] = (
-                    a["distance"] * 0.00062137
+                    a["distance"] * METERS_TO_MILES
                 )  # source data is in meters, convert to miles
                 am_dict["equipment"] = gear[a["gear_id"]] if a["gear_id"] else ""
 
@@ -169,10 +269,28 @@ class RideWithGPSActivities(object):
 
                 am_dict["source"] = "RideWithGPS"
 
-                am, created = ActivityMetadata.get_or_create(**am_dict)
-                am.save()
+                if a["id"] in known:
+                    am = known[a["id"]]
+                    # renamed or regeared upstream, and already stored
+                    if am.update_fields(am_dict) and am.id is not None:
+                        changed[am.id] = am
+                else:
+                    am = known[a["id"]] = ActivityMetadata(**am_dict)
+                    new_activities.append(am)
 
                 self.activities_metadata.append(am)
 
             except Exception as e:
                 print("Exception Saving RideWithGPS Activity:", e)
+
+        ActivityMetadata.bulk_save(
+            new_activities,
+            ActivityMetadata.ridewithgps_id,
+            list(changed.values()),
+            [
+                ActivityMetadata.date,
+                ActivityMetadata.distance,
+                ActivityMetadata.equipment,
+                ActivityMetadata.notes,
+            ],
+        )
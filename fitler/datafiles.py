@@ -1,34 +1,46 @@
 """Defines interactions with files on disk"""
-from fitler.metadata import ActivityMetadata
+from fitler.metadata import ActivityMetadata, METERS_TO_MILES, db
 
 import glob
-import tempfile
+import itertools
+import io
 import gzip
 import json
+from pathlib import PurePath
+from xml.etree import ElementTree
 
 import gpxpy
 import gpxpy.gpx
-import tcxparser  # type: ignore
 import fitparse  # type: ignore
 
+# file suffixes -> (file_type, gzipped)
+FILE_TYPES = {
+    (".fit", ".gz"): ("FIT", 1),
+    (".tcx", ".gz"): ("TCX", 1),
+    (".gpx", ".gz"): ("GPX", 1),
+    (".gpx",): ("GPX", 0),
+}
+
 
 class ActivityFileCollection(object):
     def __init__(self, folder):
         self.folder = folder
         self.activities_metadata = []
 
+    @db.atomic()  # commit every file at once
     def process(self, limit=-1):
         gen = glob.iglob(self.folder)
+        if limit > 0:
+            gen = itertools.islice(gen, limit)
 
-        counter = 0
         for file in gen:
-            if limit > 0 and counter == limit:
-                break
-            else:
-                counter += 1
-                af = ActivityFile(file)
-                am = af.parse()
-                self.activities_metadata.append(am)
+            try:
+                # savepoint, so a bad or unknown file (and the row created
+                # for it) only rolls back itself
+                with db.atomic():
+                    self.activities_metadata.append(ActivityFile(file).parse())
+            except Exception as e:
+                print("Exception Parsing Activity File:", file, e)
 
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
@@ -37,77 +49,79 @@ class ActivityFileCollection(object):
 class ActivityFile(object):
     def __init__(self, file):
         self.file = file
-        self.activity_metadata, created = ActivityMetadata.get_or_create(
-            original_filename=file.split("/")[-1]
-        )
+        path = PurePath(file)
 
-        if ".fit.gz" in self.file:
-            self.file_type = "FIT"
-            self.gzipped = 1
-        elif ".tcx.gz" in self.file:
-            self.file_type = "TCX"
-            self.gzipped = 1
-        elif ".gpx.gz" in self.file:
-            self.file_type = "GPX"
-            self.gzipped = 1
-        elif ".gpx" in self.file:
-            self.file_type = "GPX"
-            self.gzipped = 0
-        else:
+        suffixes = tuple(suffix.lower() for suffix in path.suffixes)
+        file_type = FILE_TYPES.get(suffixes[-2:]) or FILE_TYPES.get(suffixes[-1:])
+        if file_type is None:
             raise ValueError("Why hello there unknown file format!", self.file)
+        self.file_type, self.gzipped = file_type
 
+        self.activity_metadata, created = ActivityMetadata.get_or_create(
+            original_filename=path.name
+        )
         self.activity_metadata.save()
 
     def parse(self):
-        read_file = self.file
-        fp = 0
-
-        if self.gzipped:
-            fp = tempfile.NamedTemporaryFile()
-            with gzip.open(self.file, "rb") as f:
-                fp.write(f.read().lstrip())
-            read_file = fp.name
-
-        if "FIT" == self.file_type:
-            self.process_fit(read_file)
-        elif "TCX" == self.file_type:
-            self.process_tcx(read_file)
-        elif "GPX" == self.file_type:
-            self.process_gpx(read_file)
-        else:
-            raise ValueError("Why hello there unknown file format!", self.file_type)
-
-        if self.gzipped:
-            fp.close()
+        with self.open_file() as fp:
+            if "FIT" == self.file_type:
+                self.process_fit(fp)
+            elif "TCX" == self.file_type:
+                self.process_tcx(fp)
+            elif "GPX" == self.file_type:
+                self.process_gpx(fp)
+            else:
+                raise ValueError("Why hello there unknown file format!", self.file_type)
 
         self.activity_metadata.source = "File"
         self.activity_metadata.save()
         return self.activity_metadata
 
+    def open_file(self):
+        if self.gzipped:
+            # decompress in memory, the parsers all accept file-like objects
+            with gzip.open(self.file, "rb") as f:
+                return io.BytesIO(f.read().lstrip())
+        return open(self.file, "rb")
+
     def process_gpx(self, file):
         # probably should convert these to a TCX file
         # examples at https://github.com/tkrajina/gpxpy/blob/dev/gpxinfo
-        gpx_file = open(file, "r")
-        gpx = gpxpy.parse(gpx_file)
+        gpx = gpxpy.parse(file)
         self.activity_metadata.set_start_time(str(gpx.get_time_bounds().start_time))
-        self.activity_metadata.distance = gpx.length_2d() * 0.00062137
+        self.activity_metadata.distance = gpx.length_2d() * METERS_TO_MILES
 
     def process_fit(self, file):
         # should these get converted to tcx, or vice versa?
         # examples at fitdump -n session 998158033.fit
         try:
-            fitfile = fitparse.FitFile(file)
-            for record in fitfile.get_messages("session"):
-                for data in record:
-                    if str(data.name) == "start_time":
-                        self.activity_metadata.set_start_time(str(data.value))
-                    elif data.name == "total_distance":
-                        self.activity_metadata.distance = data.value * 0.00062137
-        except Exception as e:
+            # crc checking is done byte by byte in python, skip it
+            fitfile = fitparse.FitFile(file, check_crc=False)
+            # the first session has what we need, stop before decoding the rest
+            session = next(fitfile.get_messages("session"), None)
+            if session is not None:
+                if (start_time := session.get_value("start_time")) is not None:
+                    self.activity_metadata.set_start_time(str(start_time))
+                if (total_distance := session.get_value("total_distance")) is not None:
+                    self.activity_metadata.distance = total_distance * METERS_TO_MILES
+        except (ValueError, TypeError) as e:
+            # a truncated or corrupt file (FitParseError is a ValueError) or an
+            # unparseable start time shouldn't stop the whole import
             self.activity_metadata.error = str(e)
 
     def process_tcx(self, file):
-        # examples at https://github.com/vkurup/python-tcxparser
-        tcx = tcxparser.TCXParser(file)
-        self.activity_metadata.set_start_time(str(tcx.started_at))
-        self.activity_metadata.distance = tcx.distance * 0.00062137
+        # Same values python-tcxparser gives for started_at and distance, but
+        # streamed so the trackpoints never have to be held in memory at once.
+        start_time = None
+        distance = 0.0
+        for event, elem in ElementTree.iterparse(file, events=("start", "end")):
+            tag = elem.tag.rpartition("}")[2]
+            if event == "start":
+                if start_time is None and tag == "Lap":
+                    start_time = elem.get("StartTime")
+            elif tag == "Trackpoint":
+                if (meters := elem.find("{*}DistanceMeters")) is not None:
+                    distance = float(meters.text)
+                elem.clear()
+        self.activity_metadata.set_start_time(str(start_time))
+        self.activity_metadata.distance = distance * METERS_TO_MILES
@@ -1,19 +1,53 @@
 """Defines our data model."""
 import json
-import dateparser
+from datetime import date, datetime, timezone
+from functools import lru_cache
 import pytz
 from peewee import (
     SqliteDatabase,
     Model,
     DateTimeField,
     CharField,
-    DecimalField,
     FloatField,
     IntegerField,
     DateField,
 )
 
-db = SqliteDatabase("metadata.sqlite3")
+db = SqliteDatabase(
+    "metadata.sqlite3",
+    pragmas={
+        "journal_mode": "wal",
+        "cache_size": -20000,  # 20MB page cache
+        "mmap_size": 268435456,
+    },
+)
+
+# Every start time is stored in the same zone, only look it up once.
+eastern = pytz.timezone("US/Eastern")
+
+# Sources report distance in meters, we store miles.
+METERS_TO_MILES = 0.00062137
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    # YYYY-MM-DD of a datetime or timestamp string, in whatever zone it is in.
+    # The APIs send ISO 8601, so only fall back to dateparser when that fails.
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    value = str(value)
+    if value[4:5] == value[7:8] == "-" and value[10:11] in ("", "T", " "):
+        # already starts with YYYY-MM-DD, only check it's a real date
+        date.fromisoformat(value[:10])
+        return value[:10]
+    try:
+        return datetime.fromisoformat(value).strftime("%Y-%m-%d")
+    except ValueError:
+        import dateparser  # slow to import, and rarely needed
+
+        if (parsed := dateparser.parse(value)) is None:
+            raise ValueError("Why hello there unknown date!", value)
+        return parsed.strftime("%Y-%m-%d")
 
 
 class ActivityMetadata(Model):
@@ -24,11 +58,11 @@ class ActivityMetadata(Model):
     location_name = CharField(null=True)
     city = CharField(null=True)
     state = CharField(null=True)
-    temperature = DecimalField(null=True)
+    temperature = FloatField(null=True)
     equipment = CharField(null=True)
     duration_hms = CharField(null=True)
     distance = FloatField(null=True)
-    max_speed = DecimalField(null=True)
+    max_speed = FloatField(null=True)
     avg_heart_rate = IntegerField(null=True)
     max_heart_rate = IntegerField(null=True)
     calories = IntegerField(null=True)
@@ -43,22 +77,79 @@ class ActivityMetadata(Model):
     source = CharField(null=True)
 
     def set_start_time(self, datetimestring):
-        timezone_datetime_obj = dateparser.parse(
-            datetimestring,
-            settings={"TIMEZONE": "GMT", "RETURN_AS_TIMEZONE_AWARE": True},
-        ).astimezone(pytz.timezone("US/Eastern"))
+        # The files hand us ISO 8601, which the stdlib parses far faster than
+        # dateparser. Naive times are GMT either way.
+        try:
+            datetime_obj = datetime.fromisoformat(datetimestring)
+        except ValueError:
+            import dateparser
+
+            datetime_obj = dateparser.parse(
+                datetimestring,
+                settings={"TIMEZONE": "GMT", "RETURN_AS_TIMEZONE_AWARE": True},
+            )
+            if datetime_obj is None:
+                raise ValueError("Why hello there unknown start time!", datetimestring)
+        if datetime_obj.tzinfo is None:
+            datetime_obj = datetime_obj.replace(tzinfo=timezone.utc)
+        timezone_datetime_obj = datetime_obj.astimezone(eastern)
 
         self.start_time = timezone_datetime_obj.replace(microsecond=0).isoformat()
         self.date = timezone_datetime_obj.strftime("%Y-%m-%d")
 
+    def update_fields(self, values):
+        # copy values onto the row, True if any of them were different
+        changed = False
+        for name, value in values.items():
+            if getattr(self, name) != self._meta.fields[name].python_value(value):
+                setattr(self, name, value)
+                changed = True
+        return changed
+
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        # __data__ holds the field values, the rest of __dict__ is peewee state
+        return json.dumps(
+            self.__data__,
+            default=lambda o: o.isoformat() if isinstance(o, date) else str(o),
+            sort_keys=True,
+            indent=4,
+        )
 
     class Meta:
         database = db  # This model uses the "metadata.sqlite3" database
+        indexes = (
+            # every sync step starts by picking out one source
+            (("source", "date"), False),
+        )
+
+    @classmethod
+    def bulk_save(cls, activities, key, changed=(), fields=()):
+        # A handful of multi-row INSERTs in one transaction instead of a
+        # round trip and commit per row. sqlite can't hand back the new ids
+        # from those, so read them back by each row's source id (key).
+        # Rows already stored that changed upstream get their fields
+        # rewritten in the same transaction.
+        with db.atomic():
+            # 40 rows * 24 columns stays under sqlite's 999 variable limit
+            if activities:
+                cls.bulk_create(activities, batch_size=40)
+            if changed:
+                cls.bulk_update(changed, fields=fields, batch_size=40)
+        if not activities:
+            return
+        ids = dict(
+            cls.select(key, cls.id)
+            .where(cls.source == activities[0].source, key.is_null(False))
+            .tuples()
+        )
+        for activity in activities:
+            activity.id = ids[getattr(activity, key.name)]
 
     @classmethod
     def migrate(self):
         db.connect()
         db.create_tables([ActivityMetadata])
+        # nothing queries by these anymore, they only slowed down inserts
+        db.execute_sql("DROP INDEX IF EXISTS activitymetadata_date_distance")
+        db.execute_sql("DROP INDEX IF EXISTS activitymetadata_strava_id")
         db.close()
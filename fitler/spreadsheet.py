@@ -1,11 +1,10 @@
 """Defines how we interact with a local spreadsheet"""
-from fitler.metadata import ActivityMetadata
+from fitler.metadata import ActivityMetadata, db, parse_date
 
 import openpyxl
 from pathlib import Path
 
 import json
-from dateutil import parser as dateparser
 
 
 class ActivitySpreadsheet(object):
@@ -13,65 +12,69 @@ class ActivitySpreadsheet(object):
         self.path = path
         self.activities_metadata = []
 
+    @db.atomic()  # one transaction for the whole sheet
     def parse(self):
         xlsx_file = Path("ActivityData", self.path)
         wb_obj = openpyxl.load_workbook(xlsx_file)
         sheet = wb_obj.active
 
-        col_names = []
-        for column in sheet.iter_cols(1, sheet.max_column):
-            col_names.append(column[0].value)
-
         for i, row in enumerate(sheet.iter_rows(values_only=True)):
             if i != 0:
-                am_dict = {}
-                am_dict["date"] = dateparser.parse(str(row[0])).strftime("%Y-%m-%d")
-                if activity_type := row[1]:
-                    am_dict["activity_type"] = activity_type
-                if location_name := row[2]:
-                    am_dict["location_name"] = location_name
-                if city := row[3]:
-                    am_dict["city"] = city
-                if state := row[4]:
-                    am_dict["state"] = state
-                if temperature := row[5]:
-                    am_dict["temperature"] = temperature
-                if equipment := row[6]:
-                    am_dict["equipment"] = equipment
-                if duration_hms := row[7]:
-                    am_dict["duration_hms"] = duration_hms
-                if distance := row[8]:
-                    am_dict["distance"] = distance
-                if max_speed := row[9]:
-                    am_dict["max_speed"] = max_speed
-                if avg_heart_rate := row[10]:
-                    am_dict["avg_heart_rate"] = avg_heart_rate
-                if max_heart_rate := row[11]:
-                    am_dict["max_heart_rate"] = max_heart_rate
-                if calories := row[12]:
-                    am_dict["calories"] = calories
-                if max_elevation := row[13]:
-                    am_dict["max_elevation"] = max_elevation
-                if total_elevation_gain := row[14]:
-                    am_dict["total_elevation_gain"] = total_elevation_gain
-                if with_names := row[15]:
-                    am_dict["with_names"] = with_names
-                if avg_cadence := row[16]:
-                    am_dict["avg_cadence"] = avg_cadence
-                if strava_id := row[17]:
-                    am_dict["strava_id"] = strava_id
-                if garmin_id := row[18]:
-                    am_dict["garmin_id"] = garmin_id
-                if ridewithgps_id := row[19]:
-                    am_dict["ridewithgps_id"] = ridewithgps_id
-                if notes := row[20]:
-                    am_dict["notes"] = notes
+                try:
+                    # savepoint, so a bad row only rolls back itself
+                    with db.atomic():
+                        self.activities_metadata.append(self.parse_row(row))
+                except Exception as e:
+                    print("Exception Parsing Spreadsheet Row:", i + 1, e)
 
-                am_dict["source"] = "Spreadsheet"
-                am, created = ActivityMetadata.get_or_create(**am_dict)
-                am.save()
+    def parse_row(self, row):
+        am_dict = {}
+        am_dict["date"] = parse_date(row[0])
+        if activity_type := row[1]:
+            am_dict["activity_type"] = activity_type
+        if location_name := row[2]:
+            am_dict["location_name"] = location_name
+        if city := row[3]:
+            am_dict["city"] = city
+        if state := row[4]:
+            am_dict["state"] = state
+        if temperature := row[5]:
+            am_dict["temperature"] = temperature
+        if equipment := row[6]:
+            am_dict["equipment"] = equipment
+        if duration_hms := row[7]:
+            am_dict["duration_hms"] = duration_hms
+        if distance := row[8]:
+            am_dict["distance"] = distance
+        if max_speed := row[9]:
+            am_dict["max_speed"] = max_speed
+        if avg_heart_rate := row[10]:
+            am_dict["avg_heart_rate"] = avg_heart_rate
+        if max_heart_rate := row[11]:
+            am_dict["max_heart_rate"] = max_heart_rate
+        if calories := row[12]:
+            am_dict["calories"] = calories
+        if max_elevation := row[13]:
+            am_dict["max_elevation"] = max_elevation
+        if total_elevation_gain := row[14]:
+            am_dict["total_elevation_gain"] = total_elevation_gain
+        if with_names := row[15]:
+            am_dict["with_names"] = with_names
+        if avg_cadence := row[16]:
+            am_dict["avg_cadence"] = avg_cadence
+        if strava_id := row[17]:
+            am_dict["strava_id"] = strava_id
+        if garmin_id := row[18]:
+            am_dict["garmin_id"] = garmin_id
+        if ridewithgps_id := row[19]:
+            am_dict["ridewithgps_id"] = ridewithgps_id
+        if notes := row[20]:
+            am_dict["notes"] = notes
 
-                self.activities_metadata.append(am)
+        am_dict["source"] = "Spreadsheet"
+        am, created = ActivityMetadata.get_or_create(**am_dict)
+        am.save()
+        return am
 
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
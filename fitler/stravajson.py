@@ -1,7 +1,6 @@
 """Handles locally cached strava json"""
-from fitler.metadata import ActivityMetadata
+from fitler.metadata import ActivityMetadata, METERS_TO_MILES, db, parse_date
 
-import dateparser
 import glob
 import json
 
@@ -11,6 +10,7 @@ class StravaJsonActivities(object):
         self.folder = folder
         self.activities_metadata = []
 
+    @db.atomic()
     def process(self, limit=-1):
         gen = glob.iglob(self.folder)
 
@@ -20,17 +20,19 @@ class StravaJsonActivities(object):
                 break
             else:
                 counter += 1
-                with open(file) as f:
-                    data = json.load(f)
-                    am_dict = {}
-                    am_dict["date"] = dateparser.parse(
-                        data["start_date_local"]
-                    ).strftime("%Y-%m-%d")
-                    am_dict["distance"] = data["distance"] * 0.00062137
-                    am_dict["strava_id"] = data["id"]
-                    am_dict["notes"] = data["name"]
-                    am_dict["source"] = "StravaFile"
+                try:
+                    # savepoint, so a bad file only rolls back itself
+                    with db.atomic(), open(file) as f:
+                        data = json.load(f)
+                        am_dict = {}
+                        am_dict["date"] = parse_date(data["start_date_local"])
+                        am_dict["distance"] = data["distance"] * METERS_TO_MILES
+                        am_dict["strava_id"] = data["id"]
+                        am_dict["notes"] = data["name"]
+                        am_dict["source"] = "StravaFile"
 
-                    am, created = ActivityMetadata.get_or_create(**am_dict)
-                    am.save()
-                    self.activities_metadata.append(am)
+                        am, created = ActivityMetadata.get_or_create(**am_dict)
+                        am.save()
+                        self.activities_metadata.append(am)
+                except Exception as e:
+                    print("Exception Parsing Strava JSON File:", file, e)
@@ -1,8 +1,12 @@
 # import os
-import copy
+from collections import defaultdict
+from functools import lru_cache
 
 # from pprint import pprint
+from peewee import chunked
+from playhouse.shortcuts import model_to_dict
 import fitler
+from fitler.metadata import db
 
 # uncomment this to get SQL Logging
 # import logging
@@ -44,45 +48,46 @@ quit()
 # Load from Garmin somehow.
 
 
+# every row of a source, grouped by date, so matching is a dict lookup
+# instead of a query per activity. Sources aren't changed while matching.
+candidates = {}
+
+
+def candidates_for(source):
+    if source not in candidates:
+        candidates[source] = defaultdict(list)
+        for am in fitler.ActivityMetadata.select().where(
+            fitler.ActivityMetadata.source == source
+        ):
+            candidates[source][am.date].append(am)
+    return candidates[source]
+
+
 # this is where we match
-# targetmetadata is what we want to match on as a dict: {date: '2020-11-07', distance: 1.32 }
+# date and distance are what we want to match on: '2020-11-07', 1.32
 # source is where we are looking: "StravaFile"
 # return is ActivityMetadata -> the match itself, but only if there is one and only one
-def bestmatch(targetmetadata, source):
+# candidates never change during a run, so the answer for a triple doesn't either
+@lru_cache(maxsize=None)
+def bestmatch(date, distance, source):
     # print('-----------')
-    # print("Matching:", targetmetadata['date'], '-', targetmetadata['distance'])
-    matches = 0
-    match = None
-    for am in fitler.ActivityMetadata.select().where(
-        fitler.ActivityMetadata.source == source,
-        fitler.ActivityMetadata.date == targetmetadata["date"],
-        fitler.ActivityMetadata.distance <= targetmetadata["distance"] * 1.2,
-        fitler.ActivityMetadata.distance >= targetmetadata["distance"] * 0.8,
-    ):
-        match = am
-        matches += 1
-        # print("~", am.date, "-", am.distance)
-    for am in fitler.ActivityMetadata.select().where(
-        fitler.ActivityMetadata.source == source,
-        fitler.ActivityMetadata.date == targetmetadata["date"],
-        fitler.ActivityMetadata.distance > targetmetadata["distance"] * 1.2,
-    ):
-        matches += 0
-        # print("+", am.date, "-", am.distance)
-    for am in fitler.ActivityMetadata.select().where(
-        fitler.ActivityMetadata.source == source,
-        fitler.ActivityMetadata.date == targetmetadata["date"],
-        fitler.ActivityMetadata.distance < targetmetadata["distance"] * 0.8,
-    ):
-        matches += 0
-        # print("-", am.date, "-", am.distance)
-    if matches < 1:
+    # print("Matching:", date, '-', distance)
+    low = distance * 0.8
+    high = distance * 1.2
+    matches = []
+    for am in candidates_for(source).get(date, []):
+        if am.distance is not None and low <= am.distance <= high:
+            matches.append(am)
+            # only need to tell "exactly one" from "none" or "too many"
+            if len(matches) > 1:
+                break
+    if len(matches) < 1:
         # print("Error: no matches!")
         return None
-    elif matches > 1:
+    elif len(matches) > 1:
         # print("Error: too many matches!")
         return None
-    return match
+    return matches[0]
 
 
 # Populate the "Main" from the spreadsheet if we need to
@@ -93,57 +98,61 @@ if (
     == 0
 ):
     print("--- Populating Main from Spreadsheet ---")
-    for activity in fitler.ActivityMetadata.select().where(
-        fitler.ActivityMetadata.source == "Spreadsheet"
-    ):
-        activity_copy = copy.deepcopy(activity)
-        activity_copy.id = None
-        activity_copy.source = "Main"
-        activity_copy.save()
+    main_rows = [
+        {
+            **model_to_dict(activity, exclude=[fitler.ActivityMetadata.id]),
+            "source": "Main",
+        }
+        for activity in fitler.ActivityMetadata.select().where(
+            fitler.ActivityMetadata.source == "Spreadsheet"
+        )
+    ]
+    with db.atomic():
+        # same batch size as ActivityMetadata.bulk_save, for SQLite's variable limit
+        for batch in chunked(main_rows, 40):
+            fitler.ActivityMetadata.insert_many(batch).execute()
 
 
 # Fill in the missing strava IDs from Strava File using ~match. How many are missing?
 missingstrava = fitler.ActivityMetadata.select().where(
-    fitler.ActivityMetadata.source == "Main", fitler.ActivityMetadata.strava_id == ""
+    fitler.ActivityMetadata.source == "Main",
+    fitler.ActivityMetadata.strava_id.is_null(True),
 )
 print("--------- Main is sadly missing strava_id for:", len(missingstrava), "---------")
-for activity in missingstrava:
-    candidate = bestmatch(
-        {"distance": activity.distance, "date": activity.date}, "StravaFile"
-    )
-    if candidate:
-        print("StravaFile", candidate.strava_id, "was lonely! Found a match.")
-        activity.strava_id = candidate.strava_id
-        activity.save()
-missingstrava = fitler.ActivityMetadata.select().where(
-    fitler.ActivityMetadata.source == "Main", fitler.ActivityMetadata.strava_id == ""
-)
+matched = 0
+with db.atomic():
+    for activity in missingstrava:
+        candidate = bestmatch(activity.date, activity.distance, "StravaFile")
+        if candidate:
+            print("StravaFile", candidate.strava_id, "was lonely! Found a match.")
+            activity.strava_id = candidate.strava_id
+            activity.save()
+            matched += 1
 print(
     "--------- Main is now happily only missing strava_id for:",
-    len(missingstrava),
+    len(missingstrava) - matched,
     "---------",
 )
 
 
 # Then do it from actual Strava with ~match. How many are missing?
 missingstrava = fitler.ActivityMetadata.select().where(
-    fitler.ActivityMetadata.source == "Main", fitler.ActivityMetadata.strava_id == ""
+    fitler.ActivityMetadata.source == "Main",
+    fitler.ActivityMetadata.strava_id.is_null(True),
 )
 print("--------- Main is sadly missing strava_id for:", len(missingstrava), "---------")
-for activity in missingstrava:
-    candidate = bestmatch(
-        {"distance": activity.distance, "date": activity.date}, "Strava"
-    )
-    if candidate:
-        print("Strava", candidate.strava_id, "was lonely! Found a match.")
-        activity.strava_id = candidate.strava_id
-        activity.save()
-missingstrava = fitler.ActivityMetadata.select().where(
-    fitler.ActivityMetadata.source == "Main", fitler.ActivityMetadata.strava_id == ""
-)
+matched = 0
+with db.atomic():
+    for activity in missingstrava:
+        candidate = bestmatch(activity.date, activity.distance, "Strava")
+        if candidate:
+            print("Strava", candidate.strava_id, "was lonely! Found a match.")
+            activity.strava_id = candidate.strava_id
+            activity.save()
+            matched += 1
 print(
     "--------- Main is now happily only missing strava_id for:",
-    len(missingstrava),
+    len(missingstrava) - matched,
     "---------",
 )
 
@@ -151,20 +160,21 @@ print(
 # Fill in the missing file IDs from File using ~match.  How many are missing?
 missingfiles = fitler.ActivityMetadata.select().where(
     fitler.ActivityMetadata.source == "Main",
-    fitler.ActivityMetadata.original_filename is None,
+    fitler.ActivityMetadata.original_filename.is_null(True),
 )
 print("--------- Main is sadly missing file for:", len(missingfiles), "---------")
-for activity in missingfiles:
-    candidate = bestmatch(
-        {"distance": activity.distance, "date": activity.date}, "File"
-    )
-    if candidate:
-        print("File", candidate.original_filename, "was lonely! Found a match.")
-        activity.original_filename = candidate.original_filename
-        activity.save()
+matched = 0
+with db.atomic():
+    for activity in missingfiles:
+        candidate = bestmatch(activity.date, activity.distance, "File")
+        if candidate:
+            print("File", candidate.original_filename, "was lonely! Found a match.")
+            activity.original_filename = candidate.original_filename
+            activity.save()
+            matched += 1
 print(
     "--------- Main is now happily only missing file for:",
-    len(missingfiles),
+    len(missingfiles) - matched,
     "---------",
 )
 
@@ -172,52 +182,59 @@ print(
 # Fill in the missing garmin IDs from Garmin using ~match.
 # How many are missing?
 missinggarmin = fitler.ActivityMetadata.select().where(
-    fitler.ActivityMetadata.source == "Main", fitler.ActivityMetadata.garmin_id is None
+    fitler.ActivityMetadata.source == "Main",
+    fitler.ActivityMetadata.garmin_id.is_null(True),
 )
-print("--------- Main is missing garmin_id for:", len(missinggarmin), "---------")
+print("--------- Main is missing garmin_id for:", missinggarmin.count(), "---------")
 
 
 # Fill in the missing RidewithGPS IDs from RidewithGPS using ~match.
 # How many are missing?
 missingridewithgps = fitler.ActivityMetadata.select().where(
     fitler.ActivityMetadata.source == "Main",
-    fitler.ActivityMetadata.ridewithgps_id is None,
+    fitler.ActivityMetadata.ridewithgps_id.is_null(True),
 )
 print(
     "--------- Main is sadly missing ridewithgps_id for:",
     len(missingridewithgps),
     "---------",
 )
-for activity in missingridewithgps:
-    candidate = bestmatch(
-        {"distance": activity.distance, "date": activity.date}, "RideWithGPS"
-    )
-    if candidate:
-        print("RideWithGPS", candidate.ridewithgps_id, "was lonely! Found a match.")
-        activity.ridewithgps_id = candidate.ridewithgps_id
-        activity.save()
-missingridewithgps = fitler.ActivityMetadata.select().where(
-    fitler.ActivityMetadata.source == "Main",
-    fitler.ActivityMetadata.ridewithgps_id is None,
-)
+matched = 0
+with db.atomic():
+    for activity in missingridewithgps:
+        candidate = bestmatch(activity.date, activity.distance, "RideWithGPS")
+        if candidate:
+            print("RideWithGPS", candidate.ridewithgps_id, "was lonely! Found a match.")
+            activity.ridewithgps_id = candidate.ridewithgps_id
+            activity.save()
+            matched += 1
 print(
     "--------- Main is now happily only missing ridewithgps_id for:",
-    len(missingridewithgps),
+    len(missingridewithgps) - matched,
     "---------",
 )
 
 
 # Figure out which things in RideWithGPS need Gear and Names updated
 ridewithgps_gear = ridewithgpsbits.get_gear()
+# gear name -> id, keeping the first id like list.index() did for duplicate names
+ridewithgps_gear_ids = {}
+for gear_id, gear_name in ridewithgps_gear.items():
+    ridewithgps_gear_ids.setdefault(gear_name, gear_id)
+ridewithgps_updates = {}
 rides = fitler.ActivityMetadata.select().where(
     fitler.ActivityMetadata.source == "Main",
-    fitler.ActivityMetadata.ridewithgps_id is not None,
+    fitler.ActivityMetadata.ridewithgps_id.is_null(False),
 )
+ridewithgps_by_id = {
+    am.ridewithgps_id: am
+    for am in fitler.ActivityMetadata.select().where(
+        fitler.ActivityMetadata.source == "RideWithGPS"
+    )
+}
 for ride in rides:
-    ridewithgps_ride = fitler.ActivityMetadata.select().where(
-        fitler.ActivityMetadata.source == "RideWithGPS",
-        fitler.ActivityMetadata.ridewithgps_id == ride.ridewithgps_id,
-    )[0]
+    ridewithgps_ride = ridewithgps_by_id[ride.ridewithgps_id]
+    trip = {}
     if ride.equipment != ridewithgps_ride.equipment:
         print(
             "RideWithGPS",
@@ -227,14 +244,9 @@ for ride in rides:
             "to",
             ride.equipment,
             "a.k.a.",
-            list(ridewithgps_gear.keys())[
-                list(ridewithgps_gear.values()).index(ride.equipment)
-            ],
+            ridewithgps_gear_ids[ride.equipment],
         )
-        # ridewithgpsbits.set_trip_gear(
-        #     ridewithgps_ride.ridewithgps_id,
-        #     list(ridewithgps_gear.keys())[list(ridewithgps_gear.values()).index(ride.equipment)]
-        # )
+        trip["gear_id"] = ridewithgps_gear_ids[ride.equipment]
     if ride.notes != ridewithgps_ride.notes:
         print(
             "RideWithGPS",
@@ -244,10 +256,10 @@ for ride in rides:
             "to",
             ride.notes,
         )
-        # ridewithgpsbits.set_trip_name(
-        #     ridewithgps_ride.ridewithgps_id,
-        #     ride.notes
-        # )
+        trip["name"] = ride.notes
+    if trip:
+        ridewithgps_updates[ridewithgps_ride.ridewithgps_id] = trip
+# ridewithgpsbits.update_trips(ridewithgps_updates)
 
 
 # For activities not in RideWithGPS, upload them! Careful.
@@ -255,8 +267,8 @@ for ride in rides:
 # scratch to sync everything up.
 rides = fitler.ActivityMetadata.select().where(
     fitler.ActivityMetadata.source == "Main",
-    fitler.ActivityMetadata.ridewithgps_id is None,
-    fitler.ActivityMetadata.original_filename is not None,
+    fitler.ActivityMetadata.ridewithgps_id.is_null(True),
+    fitler.ActivityMetadata.original_filename.is_null(False),
 )
 for ride in rides:
     print(ride.id, "is missing from RideWithGPS. Uploading:", ride.original_filename)